@@ -1,16 +1,38 @@
 
+try:
+    import fcntl
+except ImportError:  # Windows (local dev only)
+    fcntl = None
+import hashlib
+import logging.config
 import os
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import Flask, render_template, request, redirect, url_for, flash, send_from_directory, abort, make_response, Response
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from passlib.context import CryptContext
 from werkzeug.utils import secure_filename
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import validate_csrf
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
 from wtforms import StringField, PasswordField, SubmitField, TextAreaField
-from wtforms.validators import InputRequired, Length, EqualTo
+from wtforms.validators import InputRequired, Length, EqualTo, ValidationError
 from apscheduler.schedulers.background import BackgroundScheduler
+import orjson
+import pandas as pd
 import yfinance as yf
+from yfinance import shared as yf_shared
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 
 # ----------------------
 # Config
@@ -19,6 +41,25 @@ BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Logging: INFO to stderr, or appended to LOG_FILE when set. Several Gunicorn workers
+# share that file, so rotate it externally (e.g. logrotate); WatchedFileHandler reopens
+# it after rotation instead of each worker rotating it on its own
+_log_handler = {'class': 'logging.StreamHandler', 'formatter': 'default'}
+if os.environ.get('LOG_FILE'):
+    _log_handler = {
+        'class': 'logging.handlers.WatchedFileHandler',
+        'formatter': 'default',
+        'filename': os.environ['LOG_FILE'],
+    }
+logging.config.dictConfig({
+    'version': 1,
+    # Imported after Gunicorn sets up its own loggers (preload_app); leave those alone
+    'disable_existing_loggers': False,
+    'formatters': {'default': {'format': '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'}},
+    'handlers': {'default': _log_handler},
+    'root': {'level': 'INFO', 'handlers': ['default']},
+})
+
 app = Flask(__name__)
 
 # Prefer DATABASE_URL if provided (e.g., Render Postgres)
@@ -30,17 +71,32 @@ if db_url:
     elif db_url.startswith("postgresql://"):
         db_url = db_url.replace("postgresql://", "postgresql+psycopg2://", 1)
     app.config['SQLALCHEMY_DATABASE_URI'] = db_url
+    # Keep a warm pool of connections and drop stale ones (e.g. after a DB restart)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'pool_use_lifo': True,
+    }
 else:
     # Fallback to SQLite (works with a Render Disk)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(BASE_DIR, 'app.db')
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'check_same_thread': False}}
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+# When running behind nginx, set to its internal location (e.g. /internal_uploads/) so
+# nginx serves upload files via X-Accel-Redirect instead of a Gunicorn worker
+app.config['UPLOADS_ACCEL_PREFIX'] = os.environ.get('UPLOADS_ACCEL_PREFIX')
+
+# Posts per feed page
+PAGE_SIZE = 20
 
 # Allowed image types
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif'})
 
 # ----------------------
 # Extensions
@@ -49,40 +105,92 @@ db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
+# Password hashing (argon2); legacy Werkzeug hashes are upgraded on next login
+pwd_ctx = CryptContext(schemes=['argon2'], argon2__memory_cost=19456, argon2__time_cost=2, argon2__parallelism=1)
+
+# Recent verification results, so repeated logins (or bots retrying) skip the hash
+PASSWORD_CACHE_SIZE = 1024
+PASSWORD_CACHE_SECONDS = 60
+_password_cache = OrderedDict()
+_password_cache_lock = threading.Lock()
+
+def verify_password(password_hash, password):
+    # Key on a digest salted by the stored hash so plaintext passwords are never kept
+    key = hashlib.sha256((password_hash + password).encode()).hexdigest()
+    now = time.time()
+    with _password_cache_lock:
+        hit = _password_cache.get(key)
+    if hit and now - hit[1] < PASSWORD_CACHE_SECONDS:
+        return hit[0]
+    verified = pwd_ctx.verify(password, password_hash)
+    with _password_cache_lock:
+        _password_cache[key] = (verified, now)
+        _password_cache.move_to_end(key)
+        if len(_password_cache) > PASSWORD_CACHE_SIZE:
+            _password_cache.popitem(last=False)
+    return verified
+
 # ----------------------
 # Models
 # ----------------------
+def utcnow():
+    # Python-side default as well as server_default: tables created before the server
+    # default existed are not altered by create_all(), so they rely on this one
+    return datetime.now(timezone.utc)
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
+    username = db.Column(db.String(80), unique=True, nullable=False, index=True)
     password_hash = db.Column(db.String(200), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow, server_default=db.func.now(), nullable=False)
+
+    # Case-insensitive lookups (and uniqueness) for register/login
+    __table_args__ = (
+        db.Index('ix_user_username_lower', db.func.lower(username), unique=True),
+    )
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = pwd_ctx.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if pwd_ctx.identify(self.password_hash, required=False) is None:
+            # Legacy Werkzeug hash: verify it the old way, then rehash with argon2
+            if not check_password_hash(self.password_hash, password):
+                return False
+            self.set_password(password)
+            db.session.commit()
+            return True
+        return verify_password(self.password_hash, password)
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image_filename = db.Column(db.String(200), nullable=False)
     caption = db.Column(db.Text, nullable=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime(timezone=True), default=utcnow, server_default=db.func.now(), nullable=False)
     user = db.relationship('User', backref=db.backref('posts', lazy=True))
 
+    # Indexes backing the newest-first feed queries
+    __table_args__ = (
+        db.Index('ix_post_created_at', created_at.desc(), id.desc()),
+        db.Index('ix_post_user_created', user_id, created_at.desc(), id.desc()),
+    )
+
 # ----------------------
 # Forms
 # ----------------------
+def strip_filter(value):
+    return value.strip() if isinstance(value, str) else value
+
 class RegisterForm(FlaskForm):
-    username = StringField('Username', validators=[InputRequired(), Length(min=3, max=80)])
+    # Strip before validating so Length sees the name that will actually be stored
+    username = StringField('Username', validators=[InputRequired(), Length(min=3, max=80)], filters=[strip_filter])
     password = PasswordField('Password', validators=[InputRequired(), Length(min=4)])
     confirm = PasswordField('Confirm password', validators=[InputRequired(), EqualTo('password')])
     submit = SubmitField('Register')
 
 class LoginForm(FlaskForm):
-    username = StringField('Username', validators=[InputRequired()])
+    username = StringField('Username', validators=[InputRequired()], filters=[strip_filter])
     password = PasswordField('Password', validators=[InputRequired()])
     submit = SubmitField('Login')
 
@@ -92,48 +200,131 @@ class PostForm(FlaskForm):
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Session.get checks the identity map before issuing a SELECT
+    return db.session.get(User, int(user_id))
 
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return bool(ext) and ext in ALLOWED_EXTENSIONS
+
+def paginate_posts(query):
+    """Return one newest-first page of posts after the ?before=<iso_ts>_<id> cursor, plus the next cursor.
+
+    The id breaks ties between posts created at the same timestamp.
+    """
+    before = request.args.get('before')
+    if before:
+        try:
+            ts, post_id = before.rsplit('_', 1)
+            query = query.filter(tuple_(Post.created_at, Post.id) < (datetime.fromisoformat(ts), int(post_id)))
+        except ValueError:
+            abort(400)
+    posts = query.order_by(Post.created_at.desc(), Post.id.desc()).limit(PAGE_SIZE).all()
+    next_before = None
+    if len(posts) == PAGE_SIZE:
+        last = posts[-1]
+        next_before = f"{last.created_at.isoformat()}_{last.id}"
+    return posts, next_before
 
 # ----------------------
 # DB init
 # ----------------------
 with app.app_context():
     db.create_all()
+    app.logger.info("DB pool: %s", db.engine.pool.status())
 
 # ----------------------
 # Market data
 # ----------------------
 market_data_cache = {}
+_market_lock = threading.Lock()
+
+# Cache Yahoo responses on disk so repeat fetches (and other Gunicorn workers) skip the network
+yf_session = CachedSession(os.path.join(BASE_DIR, 'yf_cache'), expire_after=120)
+# Long-lived keep-alive pool so cache misses reuse TLS connections to Yahoo
+yf_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10, max_retries=2))
+
+# Refresh bookkeeping for on-demand fetches when no scheduler is running
+MARKET_REFRESH_SECONDS = 120
+_last_fetch_ts = 0.0
+_fetch_lock = threading.Lock()
 
 def fetch_market_data():
     tickers = ['^DJI', '^GSPC', '^IXIC', 'AAPL', 'MSFT']
     data = {}
     try:
-        yf_tickers = yf.Tickers(' '.join(tickers))
-        for t in tickers:
-            tk = yf_tickers.tickers.get(t) or yf.Ticker(t)
-            info = tk.history(period='1d')
-            last_price = None
-            change = None
-            if not info.empty:
-                last_price = float(info['Close'][-1])
-                open_price = float(info['Open'][-1])
-                change = last_price - open_price
-            else:
-                q = getattr(tk, 'fast_info', {}) or {}
-                last_price = q.get('last_price')
-            data[t] = {'last': last_price, 'change': change}
-    except Exception as e:
-        print("Market fetch error:", e)
+        # One batched request for all tickers instead of a history() call per ticker
+        df = yf.download(tickers, period='1d', group_by='ticker', threads=True, progress=False,
+                         session=yf_session)
+        if not df.empty:
+            # Last known row per ticker, then one vectorized subtraction across all tickers
+            last_row = df.ffill().iloc[-1]
+            closes = last_row.xs('Close', level=1)
+            changes = closes - last_row.xs('Open', level=1)
+            for t in closes.dropna().index:
+                change = changes[t]
+                data[t] = {'last': float(closes[t]), 'change': None if pd.isna(change) else float(change)}
+    except Exception:
+        app.logger.exception("yfinance fetch failed")
         return
+    # yf.download() reports per-ticker failures in shared._ERRORS instead of raising
+    errors = dict(yf_shared._ERRORS)
     global market_data_cache
-    market_data_cache = data
+    if not data:
+        app.logger.warning("yfinance returned no market data, keeping previous snapshot: %s", errors)
+        return
+    missing = [t for t in tickers if t not in data]
+    if missing:
+        app.logger.warning("yfinance fetch incomplete, reusing previous values for %s: %s", missing, errors)
+        with _market_lock:
+            previous = market_data_cache
+        data.update({t: previous[t] for t in missing if t in previous})
+    # Publish the fully built dict in one swap so readers never see partial results
+    with _market_lock:
+        market_data_cache = data
+
+def _refresh_and_release():
+    global _last_fetch_ts
+    try:
+        fetch_market_data()
+    finally:
+        _last_fetch_ts = time.time()
+        _fetch_lock.release()
+
+scheduler = None
+_scheduler_lock_file = None
+
+def _claim_scheduler():
+    """Take a process-lifetime file lock so only one Gunicorn worker runs the scheduler.
+
+    The lock is released by the OS when that worker exits, and the replacement worker
+    claims it in turn. Other workers keep their cache fresh through /market instead.
+    """
+    global _scheduler_lock_file
+    if fcntl is None:
+        return True
+    lock_file = open(os.path.join(BASE_DIR, '.scheduler.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _scheduler_lock_file = lock_file
+    return True
+
+def start_scheduler():
+    """Start background market fetches if ENABLE_SCHEDULER=1.
 
-# Start the scheduler only if explicitly enabled (to avoid multiple schedulers under Gunicorn)
-if os.environ.get("ENABLE_SCHEDULER", "0") == "1":
+    Not run at import time: with preload_app the module is imported in the Gunicorn
+    master, and a scheduler thread started there would not survive the fork. Gunicorn
+    calls this from its post_worker_init hook (see gunicorn.conf.py).
+    """
+    global scheduler
+    # Start the scheduler only if explicitly enabled, and in one worker only
+    if os.environ.get("ENABLE_SCHEDULER", "0") != "1" or scheduler is not None:
+        return
+    if not _claim_scheduler():
+        return
     scheduler = BackgroundScheduler()
     scheduler.add_job(func=fetch_market_data, trigger="interval", minutes=5, max_instances=1, coalesce=True)
     scheduler.start()
@@ -149,18 +340,21 @@ def healthz():
 
 @app.route('/')
 def index():
-    posts = Post.query.order_by(Post.created_at.desc()).all()
-    form = PostForm()
-    return render_template('index.html', posts=posts, form=form)
+    # Eager-load authors in the same query instead of one SELECT per post
+    posts, next_before = paginate_posts(Post.query.options(joinedload(Post.user)))
+    # Only logged-in users can post, so don't build the form for anonymous visitors
+    form = PostForm() if current_user.is_authenticated else None
+    return render_template('index.html', posts=posts, form=form, next_before=next_before)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        if User.query.filter_by(username=form.username.data).first():
+        username = form.username.data
+        if User.query.filter(db.func.lower(User.username) == db.func.lower(username)).first():
             flash('Username already taken', 'danger')
             return redirect(url_for('register'))
-        user = User(username=form.username.data)
+        user = User(username=username)
         user.set_password(form.password.data)
         db.session.add(user)
         db.session.commit()
@@ -172,7 +366,7 @@ def register():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
+        user = User.query.filter(db.func.lower(User.username) == db.func.lower(form.username.data)).first()
         if user and user.check_password(form.password.data):
             login_user(user)
             flash('Logged in successfully', 'success')
@@ -190,43 +384,102 @@ def logout():
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload():
-    if 'image' not in request.files:
+    # Parse the multipart body ourselves, streaming the image straight to a temp file
+    # in the upload folder instead of letting Werkzeug spool and re-copy it
+    tmp_path = os.path.join(app.config['UPLOAD_FOLDER'], f".upload_{uuid.uuid4().hex}")
+    file_target = FileTarget(tmp_path)
+    caption_target = ValueTarget()
+    csrf_target = ValueTarget()
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+        parser.register('image', file_target)
+        parser.register('caption', caption_target)
+        parser.register('csrf_token', csrf_target)
+        while chunk := request.stream.read(65536):
+            parser.data_received(chunk)
+    except (ParseFailedException, ValueError):
+        _discard(file_target, tmp_path)
+        flash('Malformed upload', 'danger')
+        return redirect(url_for('index'))
+    except BaseException:
+        # e.g. 413 from MAX_CONTENT_LENGTH or a client disconnect mid-body
+        _discard(file_target, tmp_path)
+        raise
+    # No-op if the parser already closed the file; closes it if the body ended early
+    file_target.finish()
+    # The body bypasses PostForm, so check its CSRF token here
+    try:
+        validate_csrf(csrf_target.value.decode('utf-8', errors='replace'))
+    except ValidationError:
+        _discard(file_target, tmp_path)
+        flash('Invalid or missing CSRF token', 'danger')
+        return redirect(url_for('index'))
+    if file_target.multipart_filename is None:
+        # Also covers `image` sent as a plain field, which still opens the target file
+        _discard(file_target, tmp_path)
         flash('No image part', 'danger')
         return redirect(url_for('index'))
-    file = request.files['image']
-    caption = request.form.get('caption', '')
-    if file.filename == '':
+    if file_target.multipart_filename == '':
+        _discard(file_target, tmp_path)
         flash('No selected file', 'danger')
         return redirect(url_for('index'))
-    if file and allowed_file(file.filename):
-        filename = secure_filename(f"{current_user.id}_{int(datetime.utcnow().timestamp())}_{file.filename}")
+    if allowed_file(file_target.multipart_filename):
+        caption = caption_target.value.decode('utf-8', errors='replace')
+        filename = secure_filename(f"{current_user.id}_{int(time.time())}_{file_target.multipart_filename}")
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        os.replace(tmp_path, filepath)
         post = Post(image_filename=filename, caption=caption, user_id=current_user.id)
         db.session.add(post)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            _discard(file_target, filepath)
+            raise
         flash('Posted!', 'success')
     else:
+        _discard(file_target, tmp_path)
         flash('Invalid file type', 'danger')
     return redirect(url_for('index'))
 
+def _discard(file_target, path):
+    file_target.finish()
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 @app.route('/user/<username>')
 def profile(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(user_id=user.id).order_by(Post.created_at.desc()).all()
-    return render_template('profile.html', user=user, posts=posts)
+    user = User.query.filter(db.func.lower(User.username) == db.func.lower(username)).first_or_404()
+    posts, next_before = paginate_posts(Post.query.options(joinedload(Post.user)).filter_by(user_id=user.id))
+    return render_template('profile.html', user=user, posts=posts, next_before=next_before)
 
 @app.route('/market')
 def market():
-    # If scheduler disabled, fetch on-demand once per request
-    if os.environ.get("ENABLE_SCHEDULER", "0") != "1":
-        fetch_market_data()
-    return jsonify(market_data_cache)
+    # Always answer from the cache; if no scheduler is running and the cache is stale,
+    # refresh it in the background (at most one fetch in flight)
+    if (scheduler is None
+            and time.time() - _last_fetch_ts > MARKET_REFRESH_SECONDS
+            and _fetch_lock.acquire(blocking=False)):
+        threading.Thread(target=_refresh_and_release, daemon=True).start()
+    with _market_lock:
+        snapshot = market_data_cache
+    # orjson for the hot JSON endpoint; the app-wide provider (sessions, flashes) stays stock
+    return Response(orjson.dumps(snapshot), mimetype='application/json')
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
+    accel_prefix = app.config['UPLOADS_ACCEL_PREFIX']
+    if accel_prefix:
+        resp = make_response('')
+        resp.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + secure_filename(filename)
+        # Let nginx pick the content type from the file
+        resp.headers['Content-Type'] = ''
+        return resp
     return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
 
 if __name__ == '__main__':
     # For local testing only. In Render, Gunicorn runs the app.
+    start_scheduler()
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
@@ -0,0 +1,64 @@
+# Gunicorn settings (picked up automatically from the working directory)
+import gc
+import os
+
+# Import the app once in the master so workers share its memory copy-on-write
+preload_app = True
+
+# The app is I/O bound (DB, Yahoo, files): threaded workers share one heap per process.
+# Keep threads <= SQLALCHEMY_ENGINE_OPTIONS['pool_size'] so threads never wait on a connection,
+# and note every worker has its own pool (up to pool_size + max_overflow = 30 Postgres
+# connections), so size WEB_CONCURRENCY to the database's connection limit.
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * (os.cpu_count() or 1) + 1))
+threads = 4
+worker_class = 'gthread'
+timeout = 120
+
+# Recycle workers periodically so memory creep (pandas frames, upload buffers) can't grow unbounded.
+# With preload_app a restart is just a fork of the master, so recycling stays cheap.
+max_requests = 1000
+max_requests_jitter = 100
+# Heartbeat file on tmpfs rather than disk, where available (not on macOS)
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+# Optional hard cap: retire a worker once its RSS exceeds this many MB (0 = disabled)
+MAX_WORKER_RSS_MB = int(os.environ.get('MAX_WORKER_RSS_MB', '0'))
+
+# Keep the collector from touching (and so copying) shared objects until workers fork
+gc.disable()
+
+
+def when_ready(server):
+    # Move everything allocated during preload into the permanent generation
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+
+
+def post_worker_init(worker):
+    from app import app, db, start_scheduler, yf_session
+    # Don't reuse DB connections opened by the master (create_all) across the fork
+    with app.app_context():
+        db.engine.dispose(close=False)
+    # Same for the yfinance cache's SQLite handle; it reopens lazily in this process
+    yf_session.cache.close()
+    # Background threads must be started in the worker, never in the preloaded master;
+    # start_scheduler() lets only one worker at a time actually run it
+    start_scheduler()
+
+
+def _rss_mb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) // 1024
+    return 0
+
+
+def post_request(worker, req, environ, resp):
+    if MAX_WORKER_RSS_MB and _rss_mb() > MAX_WORKER_RSS_MB:
+        worker.log.info("Worker RSS above %s MB, restarting", MAX_WORKER_RSS_MB)
+        worker.alive = False